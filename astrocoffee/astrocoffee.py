@@ -13,14 +13,21 @@ astroph.py by Ryan T. Hamilton, Ian J. Crossfield, and Nathaniel Ross.
 """
 
 import os
+import atexit
+import contextlib
+import functools
+import json
+import queue
 import sqlite3
+import threading
 from datetime import datetime, timedelta
 import click
 from flask import Flask, request, session, g, redirect, url_for, abort, \
     render_template, flash, escape
 from flask_bcrypt import Bcrypt
+from flask_caching import Cache
 
-from .web import get_paper
+from .web import get_paper, rescrape_papers, convert_legacy_fields
 
 
 app = Flask(__name__, instance_relative_config=True)
@@ -33,14 +40,93 @@ app.config.update(dict(
     DATABASE=os.path.join(app.root_path, '../instance/astrocoffee.db')
 ))
 
+cache = Cache(app)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_window = (None, None, None)
+
 
 def connect_db():
-    """Connect to the specific database."""
-    rv = sqlite3.connect(app.config['DATABASE'])
+    """Connect to the specific database. The connection is in autocommit
+    mode, so each statement outside of `_transaction` commits on its own.
+    """
+    rv = sqlite3.connect(app.config['DATABASE'], check_same_thread=False,
+                         isolation_level=None)
     rv.row_factory = sqlite3.Row
+    rv.executescript('PRAGMA journal_mode=WAL;'
+                     'PRAGMA synchronous=NORMAL;'
+                     'PRAGMA temp_store=MEMORY;'
+                     'PRAGMA cache_size=-64000;')
     return rv
 
 
+def get_pool():
+    """Return the process-wide pool of database connections, filling it
+    with `SQLITE_POOL_SIZE` connections on first use.
+    """
+    global _pool
+
+    # Only take the lock while the pool may still need filling
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = queue.Queue(maxsize=app.config['SQLITE_POOL_SIZE'])
+                for _ in range(app.config['SQLITE_POOL_SIZE']):
+                    pool.put(connect_db())
+                db = pool.get()
+                upgrade_db(db)
+                pool.put(db)
+                _pool = pool
+
+    return _pool
+
+
+@atexit.register
+def close_pool():
+    """Close all the pooled database connections on shutdown."""
+    if _pool is not None:
+        while True:
+            try:
+                _pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+@contextlib.contextmanager
+def _transaction(db):
+    """Run the statements of the `with` block in one write transaction,
+    rolling it back if any of them fails.
+    """
+    db.execute('begin immediate')
+    try:
+        yield db
+    except BaseException:
+        db.execute('rollback')
+        raise
+    db.execute('commit')
+
+
+def upgrade_db(db):
+    """Create the indexes that are missing from an existing database, e.g.,
+    one created by an earlier version, without touching the stored papers.
+
+    :param db: Database connection.
+    :type db: sqlite3.Connection
+    :return: None
+    :rtype: None
+    """
+    tables = db.execute("select name from sqlite_master where name in "
+                        "('paper', 'idx_paper_week')").fetchall()
+    tables = [table['name'] for table in tables]
+
+    if 'paper' in tables and 'idx_paper_week' not in tables:
+        with app.open_resource('indexes.sql', mode='r') as f:
+            db.executescript(f.read())
+        db.execute('analyze')
+
+
 def init_db():
     """Initializes the database"""
     db = get_db()
@@ -48,7 +134,7 @@ def init_db():
     with app.open_resource('schema.sql', mode='r') as f:
         db.cursor().executescript(f.read())
 
-    db.commit()
+    upgrade_db(db)
 
 
 @app.cli.command('initdb')
@@ -66,6 +152,89 @@ def initdb_command():
     click.echo('Initialized the AstroCoffee database.')
 
 
+@app.cli.command('rescrape')
+@click.option('--batch-size', default=64,
+              help='Number of papers to download and save at a time.')
+@click.option('--concurrency', default=16,
+              help='Maximum number of simultaneous downloads.')
+def rescrape_command(batch_size, concurrency):
+    """Download the papers again and update their information. Only the
+    papers from websites with a working parser, i.e., arXiv, are downloaded.
+    The papers are processed in batches, and each batch is saved before the
+    next one is downloaded.
+
+    :Example:
+
+    .. code-block:: bash
+
+        $ flask rescrape
+
+    :param batch_size: Number of papers to download and save at a time.
+    :type batch_size: int
+    :param concurrency: Maximum number of simultaneous downloads.
+    :type concurrency: int
+    :return: None
+    :rtype: None
+    """
+    db = get_db()
+    last_id = 0
+    total = 0
+    updated = 0
+
+    while True:
+        rows = db.execute(('select id, url from paper where id > ? '
+                           'order by id limit ?'),
+                          [last_id, batch_size]).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+        total += len(rows)
+
+        papers = rescrape_papers([row['url'] for row in rows], concurrency)
+
+        # Skip the papers that failed to keep their previous information
+        updates = [[paper.title, paper.author, paper.author_number,
+                    paper.abstract, paper.subject, paper.sources, row['id']]
+                   for row, paper in zip(rows, papers)
+                   if paper is not None and paper.errors == '0']
+
+        with _transaction(db):
+            db.executemany(('update paper set title = ?, author = ?, '
+                            'author_number = ?, abstract = ?, subject = ?, '
+                            'sources = ? where id = ?'), updates)
+        updated += len(updates)
+
+    click.echo('Updated {} of {} papers.'.format(updated, total))
+
+
+@app.cli.command('migratedb')
+def migratedb_command():
+    """Convert the author and source links stored as html by earlier
+    versions to the author names and the arXiv download links.
+
+    :Example:
+
+    .. code-block:: bash
+
+        $ flask migratedb
+
+    """
+    db = get_db()
+    rows = db.execute('select id, author, sources from paper').fetchall()
+
+    updates = []
+    for row in rows:
+        author, sources = convert_legacy_fields(row['author'], row['sources'])
+        if author != row['author'] or sources != row['sources']:
+            updates.append([author, sources, row['id']])
+
+    with _transaction(db):
+        db.executemany('update paper set author = ?, sources = ? where id = ?',
+                       updates)
+
+    click.echo('Migrated {} of {} papers.'.format(len(updates), len(rows)))
+
+
 @app.cli.command('mkuser')
 @click.option('--user', prompt='Username', help='Login username.')
 @click.option('--password', prompt='Password', help='Login password.',
@@ -117,58 +286,157 @@ def check(p):
 
 
 def get_db():
-    """Open a new database connection if there is none yet for the
-    current application context.
+    """Check out a database connection from the pool if there is none yet
+    for the current application context.
     """
     if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = connect_db()
+        try:
+            g.sqlite_db = get_pool().get(
+                timeout=app.config['SQLITE_POOL_TIMEOUT'])
+        except queue.Empty:
+            abort(503)
     return g.sqlite_db
 
 
+_INSERT_PAPER = ('insert into paper (url, author, author_number, title, '
+                 'date_submitted, date_extended, abstract, subject, '
+                 'sources) values (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+
+def _paper_row(paper):
+    """Get the values of `paper` to insert into the paper table."""
+    return [paper.url,
+            paper.author,
+            paper.author_number,
+            paper.title,
+            paper.date_submitted,
+            paper.date_extended,
+            paper.abstract,
+            paper.subject,
+            paper.sources]
+
+
+def bulk_insert(papers):
+    """Insert multiple papers in a single transaction, e.g., when importing
+    or backfilling papers.
+
+    :param papers: Papers to insert.
+    :type papers: list
+    :return: None
+    :rtype: None
+    """
+    db = get_db()
+    with _transaction(db):
+        db.executemany(_INSERT_PAPER, [_paper_row(paper) for paper in papers])
+    # Update the statistics of the query planner after the bulk change
+    db.execute('analyze')
+    cache.delete_memoized(get_papers)
+
+
 @app.teardown_appcontext
 def close_db(error):
-    """Close the database again at the end of the request."""
+    """Return the database connection to the pool at the end of the
+    request.
+    """
     if hasattr(g, 'sqlite_db'):
-        g.sqlite_db.close()
+        # Never hand a connection that still holds a transaction, and with
+        # it maybe the write lock, to the next request
+        if g.sqlite_db.in_transaction:
+            g.sqlite_db.rollback()
+        get_pool().put(g.sqlite_db)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_datetime(date):
+    """Parse a datetime stored in the database."""
+    return datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
 
 
 @app.template_filter('strftime')
 def _jinja2_filter_datetime(date, format_=None):
     """Convert datetime to given format."""
-    date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
+    date = _parse_datetime(date)
     if format_ is None:
         format_ = '%b %d %Y'
     return date.strftime(format_)
 
 
-@app.route('/')
-def show_papers():
-    """Render the homepage."""
-    now = datetime.now()
-    week_earlier = now - timedelta(days=7)
-
-    now = now.strftime("%Y-%m-%d %H:%M")
-    week_earlier = week_earlier.strftime("%Y-%m-%d %H:%M")
+@cache.memoize()
+def get_papers(week_earlier, now):
+    """Get the papers submitted between `week_earlier` and `now`, split into
+    the new and the already discussed ones. The result is cached until a
+    paper is added or (un)marked as discussed.
 
+    :param week_earlier: Start of the window, '%Y-%m-%d %H:%M:%S'.
+    :type week_earlier: str
+    :param now: End of the window, '%Y-%m-%d %H:%M:%S'.
+    :type now: str
+    :return: Lists of new papers and discussed papers.
+    :rtype: tuple
+    """
     db = get_db()
-    cursor = db.execute(('select id, url, author, title, abstract, '
-                         'date_extended, sources, volunteer, discussed '
-                         'from paper where date_extended between '
-                         '"{}" and "{}"'.format(week_earlier, now)))
-    papers = cursor.fetchall()
-
-    new_papers = []
-    discussed_papers = []
-    for paper in papers:
-        if paper['discussed'] == 0:
-            new_papers.append(paper)
-        else:
-            discussed_papers.append(paper)
+    papers = []
+    for discussed in (0, 1):
+        cursor = db.execute(('select id, url, author, title, abstract, '
+                             'date_extended, sources, volunteer, discussed '
+                             'from paper where discussed = ? and '
+                             'date_extended between ? and ? '
+                             'order by date_extended desc'),
+                            [discussed, week_earlier, now])
+        papers.append([dict(paper) for paper in cursor.fetchall()])
+
+    new_papers, discussed_papers = papers
+    return new_papers, discussed_papers
+
+
+@app.template_filter('fromjson')
+def _jinja2_filter_fromjson(value):
+    """Decode a JSON field, e.g., the arXiv download links of a paper."""
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return []
+
+
+def get_week_window():
+    """Get the start and the end of the past week for the homepage. They are
+    computed and formatted only once a minute.
+
+    :return: Start and end of the window, '%Y-%m-%d %H:%M:%S'.
+    :rtype: tuple
+    """
+    global _window
+
+    # Read the shared window once, as other threads may replace it
+    window = _window
+    minute = datetime.now().replace(second=0, microsecond=0)
+    if window[0] != minute:
+        # Round up to the next minute so that the window, and with it the
+        # cache key of `get_papers`, changes only once a minute
+        now = minute + timedelta(minutes=1)
+        week_earlier = now - timedelta(days=7)
+        window = (minute, week_earlier.strftime('%Y-%m-%d %H:%M:%S'),
+                  now.strftime('%Y-%m-%d %H:%M:%S'))
+        _window = window
+
+    return window[1], window[2]
+
+
+def render_papers():
+    """Render the homepage with the papers submitted in the past week."""
+    week_earlier, now = get_week_window()
+    new_papers, discussed_papers = get_papers(week_earlier, now)
 
     return render_template('papers.html', new_papers=new_papers,
                            discussed_papers=discussed_papers)
 
 
+@app.route('/')
+def show_papers():
+    """Render the homepage."""
+    return render_papers()
+
+
 @app.route('/submit', methods=['POST'])
 def submit_paper():
     """Save the paper info in the database after a URL submission."""
@@ -176,25 +444,15 @@ def submit_paper():
 
     if paper is not None:
         db = get_db()
-        db.execute(('insert into paper (url, author, author_number, title,'
-                    'date_submitted, date_extended, abstract, subject,'
-                    'sources) values (?, ?, ?, ?, ?, ?, ?, ?, ?)'),
-                   [paper.url,
-                    paper.author,
-                    paper.author_number,
-                    paper.title,
-                    paper.date_submitted,
-                    paper.date_extended,
-                    paper.abstract,
-                    paper.subject,
-                    paper.sources])
-        db.commit()
+        db.execute(_INSERT_PAPER, _paper_row(paper))
+        cache.delete_memoized(get_papers)
         flash('Your submission was successfully added. Thanks for '
               'advancing knowledge!', 'success')
-    else:
-        flash('Error processing the URL or arXiv-ID! Please make sure '
-              'it\'s valid.', 'error')
+        # Render the homepage right away instead of redirecting to it
+        return render_papers()
 
+    flash('Error processing the URL or arXiv-ID! Please make sure '
+          'it\'s valid.', 'error')
     return redirect(url_for('show_papers'))
 
 
@@ -249,7 +507,7 @@ def mark_discussed():
     if paper_id is not None and session['logged_in']:
         db = get_db()
         db.execute('update paper set discussed = 1 where id = ?', [paper_id])
-        db.commit()
+        cache.delete_memoized(get_papers)
         flash('The paper has been marked as discussed.', 'success')
 
     return redirect(url_for('show_papers'))
@@ -263,7 +521,7 @@ def unmark_discussed():
     if paper_id is not None and session['logged_in']:
         db = get_db()
         db.execute('update paper set discussed = 0 where id = ?', [paper_id])
-        db.commit()
+        cache.delete_memoized(get_papers)
         flash('The paper has been marked as undiscussed.', 'success')
 
     return redirect(url_for('show_papers'))
\ No newline at end of file
@@ -0,0 +1,6 @@
+-- Covers the weekly query of the homepage, which filters on discussed and
+-- date_extended, so that it is served from the index alone. The id is not
+-- listed as every index already stores the rowid
+create index if not exists idx_paper_week
+  on paper (discussed, date_extended desc, url, author, title, abstract,
+            sources, volunteer);
\ No newline at end of file
@@ -8,8 +8,63 @@ arXiv ID. This module defines the following classes:
 
 """
 
+import re
 import requests
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Shared across submissions so that connections are kept alive and reused
+_session = requests.Session()
+
+# Seconds to wait for a response from a webpage
+_TIMEOUT = 10
+
+# New-style arXiv identifier, e.g., 1604.03939 or 1604.03939v2
+_ARXIV_ID_RE = re.compile(r'^\d{4}\.\d{4,5}(v\d+)?$')
+
+
+def _get_html(url):
+    """
+    Download the html of a webpage.
+
+    :param url: Url of the webpage.
+    :type url: str
+    :return: Html of the webpage, or `None` if it could not be retrieved.
+    :rtype: str
+    """
+    try:
+        request = _session.get(url, timeout=_TIMEOUT)
+    except requests.RequestException:
+        return None
+
+    if request.status_code == 200:
+        return request.text
+    return None
+
+
+def _probe(url):
+    """
+    Check with a HEAD request if a webpage exists. Fall back to a GET
+    request if the server does not answer the HEAD request with 200, as
+    some servers refuse HEAD but serve the page.
+
+    :param url: Url of the webpage.
+    :type url: str
+    :return: Whether the webpage exists, and its html if it was already
+        downloaded by the fallback, else `None`.
+    :rtype: tuple
+    """
+    try:
+        request = _session.head(url, allow_redirects=True, timeout=_TIMEOUT)
+    except requests.RequestException:
+        return False, None
+
+    if request.status_code == 200:
+        return True, None
+
+    html = _get_html(url)
+    return html is not None, html
 
 
 class Paper(object):
@@ -123,9 +178,9 @@ class SubmittedPaper(Paper):
         :rtype: str
         """
         # Check for the various types of arXiv identifiers
-        if '.' in url and url.replace('.', '', 1).isdigit():
+        if _ARXIV_ID_RE.match(url):
             # It's just a number so put the arXiv url prefix in front of it
-            self.is_arxiv = len(url) >= 9
+            self.is_arxiv = True
             url = self._arxiv_prefix + url
         else:
             # It's not just numbers. Look for arxiv:###... style, but not
@@ -149,25 +204,39 @@ class SubmittedPaper(Paper):
         :return: Url of the webpage if it exists, or `None`.
         :rtype: str
         """
-        try:
-            request = requests.get(url)
-            if request.status_code == 200:
-                self.html = request.text
+        # Try the url as it is and, if it has no scheme, with the `http://`
+        # and `http://www.` prefixes, all at the same time
+        candidates = [url]
+        if '://' not in url:
+            candidates.append('http://' + url)
+            if not url.startswith('www.'):
+                candidates.append('http://www.' + url)
+
+        # A url with a scheme has nothing to race against, so download it
+        # right away
+        if len(candidates) == 1:
+            html = _get_html(url)
+            if html is not None:
+                self.html = html
                 return url
-            else:
-                if not url.startswith('http://'):
-                    request = requests.get('http://' + url)
-                    if request.status_code == 200:
-                        self.html = request.text
-                        return 'http://' + url
-                    else:
-                        if not url.startswith('http://www.'):
-                            request = requests.get('http://www.' + url)
-                            if request.status_code == 200:
-                                self.html = request.text
-                                return 'http://www.' + url
-        except:
-            self.errors = 'invalid url'
+            return None
+
+        executor = ThreadPoolExecutor(max_workers=len(candidates))
+        try:
+            futures = [executor.submit(_probe, candidate)
+                       for candidate in candidates]
+
+            # Take the candidates in order of preference, without waiting for
+            # the less preferred ones once a webpage is found
+            for candidate, future in zip(candidates, futures):
+                exists, html = future.result()
+                if exists and html is None:
+                    html = _get_html(candidate)
+                if html is not None:
+                    self.html = html
+                    return candidate
+        finally:
+            executor.shutdown(wait=False)
 
         return None
 
@@ -189,18 +258,4 @@ class SubmittedPaper(Paper):
             self.url = url
         else:
             self.errors = 'Error reading ' + self._raw_url
-            self.url = ''
-
-    def retrieve_html(self):
-        """
-        Get the html of the page at `self.url`.
-
-        :return: None
-        :rtype: None
-        """
-        if self.url != '':
-            request = requests.get(self.url)
-            if request.status_code == 200:
-                self.html = request.text
-            else:
-                self.errors = 'Error reading' + self.url
\ No newline at end of file
+            self.url = ''
\ No newline at end of file
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 """
 Process the submitted url or arXiv ID and collect the associated information
-in a SubmittedPaper object. This module exports the following function:
+in a SubmittedPaper object. This module exports the following functions:
 
 `get_paper`: returns a SubmittedPaper from a url/arXiv ID.
+`fetch_papers`: coroutine to download the html of multiple urls.
+`rescrape_papers`: returns Paper objects from multiple stored urls.
+`convert_legacy_fields`: converts html author/source fields of old papers.
 
 :Example:
 
@@ -18,10 +21,37 @@ in a SubmittedPaper object. This module exports the following function:
 
 """
 
-from bs4 import BeautifulSoup as bs
 import re
+import json
+import asyncio
+import httpx
+import lxml.etree
+import lxml.html
+from urllib.parse import urlparse
 
-from .paper import SubmittedPaper
+from .paper import Paper, SubmittedPaper
+
+
+# Seconds to wait for a response while rescraping
+_TIMEOUT = 10
+
+
+_COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+_PAREN_RE = re.compile(r'\([^()]*\)')
+
+# Selectors for the arXiv abstract page
+_ARXIV_TITLE = lxml.etree.XPath("//h1[contains(@class, 'title')]")
+_ARXIV_AUTHORS = lxml.etree.XPath("//div[@class='authors']//a")
+_ARXIV_HISTORY = lxml.etree.XPath("//div[@class='submission-history']"
+                                  "//text()", smart_strings=False)
+_ARXIV_ABSTRACT = lxml.etree.XPath("//blockquote[contains(@class, "
+                                   "'abstract')]")
+_ARXIV_SOURCES = lxml.etree.XPath("//div[@class='full-text']//a")
+_ARXIV_SUBJECT = lxml.etree.XPath("//span[@class='primary-subject']/text()",
+                                  smart_strings=False)
+
+# Kinds of arXiv download links to keep, e.g., http://arxiv.org/pdf/<id>
+_ARXIV_SOURCE_KINDS = ('pdf', 'ps', 'format')
 
 
 def get_paper(url):
@@ -35,42 +65,197 @@ def get_paper(url):
     """
     paper = SubmittedPaper(url)
 
-    if paper.html == '':
-        paper.retrieve_html()
-
     if paper.errors == '0':
-        if 'nature.com' in paper.url:
-            if 'nature.com/news/' in paper.url:
-                paper = _set_web_info(paper)
-            else:
-                paper = _set_nature_info(paper)
-        elif 'adsabs.harvard.edu' in paper.url:
-            paper = _set_ads_info(paper)
-        elif 'arxiv.org' in paper.url or 'xxx.lanl.gov' in paper.url or \
-                (hasattr(paper, 'is_arxiv') and getattr(paper, 'is_arxiv')):
-            paper = _set_arxiv_info(paper)
-        elif 'aanda.org' in paper.url:
-            paper = _set_aanda_info(paper)
-        elif 'mnras.oxfordjournals.org' in paper.url:
-            paper = _set_mnras_info(paper)
-        elif 'science.sciencemag.org' in paper.url:
-            paper = _set_science_info(paper)
-        elif 'physicstoday.scitation.org' in paper.url:
-            paper = _set_physicstoday_info(paper)
-        elif 'journals.aps.org/prl/' in paper.url:
-            paper = _set_prl_info(paper)
-        elif 'voxcharta.org' in paper.url:
-            paper = _set_voxcharta_info(paper)
-        elif 'vixra.org' in paper.url:
-            paper = _set_vixra_info(paper)
-        else:
-            paper = _set_web_info(paper)
-
-        return paper
+        return _set_info(paper)
     else:
         return None
 
 
+async def fetch_papers(urls, concurrency=16):
+    """
+    Download the html of the pages at `urls` concurrently, reusing the
+    connections of a single client.
+
+    :param urls: Urls of the papers.
+    :type urls: list
+    :param concurrency: Maximum number of simultaneous requests.
+    :type concurrency: int
+    :return: Html of each page, or '' if it could not be retrieved.
+    :rtype: list
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(http2=True, limits=limits,
+                                 timeout=_TIMEOUT,
+                                 follow_redirects=True) as client:
+        async def fetch(url):
+            async with semaphore:
+                try:
+                    response = await client.get(url)
+                    if response.status_code == 200:
+                        return response.text
+                except (httpx.HTTPError, httpx.InvalidURL, ValueError,
+                        LookupError):
+                    # Covers malformed urls and undecodable pages too
+                    pass
+            return ''
+
+        return await asyncio.gather(*[fetch(url) for url in urls])
+
+
+def rescrape_papers(urls, concurrency=16):
+    """
+    Download the pages at `urls` again and retrieve the paper information.
+
+    :Example:
+
+    .. code-block:: python
+
+        papers = rescrape_papers(['https://arxiv.org/abs/1604.03939'])
+
+    :param urls: Urls of the papers, as stored in the database.
+    :type urls: list
+    :param concurrency: Maximum number of simultaneous requests.
+    :type concurrency: int
+    :return: Paper object for each url, or `None` if it failed or has no
+        working parser.
+    :rtype: list
+    """
+    # Only download the pages that a working parser can read
+    handlers = [_get_handler(url) for url in urls]
+    fetched = [url for url, handler in zip(urls, handlers)
+               if handler in _RESCRAPE_PARSERS]
+    htmls = dict(zip(fetched,
+                     asyncio.run(fetch_papers(fetched, concurrency))))
+
+    papers = []
+    for url, handler in zip(urls, handlers):
+        html = htmls.get(url, '')
+        if html == '':
+            papers.append(None)
+            continue
+
+        paper = Paper()
+        paper.url = url
+        paper.html = html
+        papers.append(handler(paper))
+
+    return papers
+
+
+def convert_legacy_fields(author, sources):
+    """
+    Convert the author and source links stored as html by earlier versions
+    to the author names and the JSON list of arXiv download links.
+
+    :param author: Stored author field.
+    :type author: str
+    :param sources: Stored sources field.
+    :type sources: str
+    :return: Converted author and sources fields.
+    :rtype: tuple
+    """
+    if author and '<' in author:
+        author = lxml.html.fragment_fromstring(
+            author, create_parent='div').text_content()
+
+    if sources and not sources.startswith('['):
+        links = lxml.html.fragment_fromstring(
+            sources, create_parent='div').iter('a')
+        sources = json.dumps(_get_arxiv_sources(links))
+
+    return author, sources
+
+
+def _get_arxiv_sources(links):
+    """
+    Get the kind and the arXiv ID of the arXiv download links, e.g.,
+    `('pdf', '1604.03939')` for a link to http://arxiv.org/pdf/1604.03939.
+
+    :param links: Link elements.
+    :type links: list
+    :return: Kind and arXiv ID of each download link.
+    :rtype: list
+    """
+    sources = []
+    for link in links:
+        path = urlparse(link.get('href', '')).path.strip('/')
+        kind, _, arxiv_id = path.partition('/')
+        if kind in _ARXIV_SOURCE_KINDS and arxiv_id != '':
+            sources.append((kind, arxiv_id))
+    return sources
+
+
+def _get_handler(url):
+    """
+    Get the parser for the website of `url`.
+
+    :param url: Url of the paper.
+    :type url: str
+    :return: Parser function, or `None` if no parser matches the host.
+    :rtype: function
+    """
+    url = urlparse(url)
+    host = url.hostname or ''
+    if host.startswith('www.'):
+        host = host[4:]
+
+    # Some pages on the journal websites are not papers
+    if host == 'nature.com' and url.path.startswith('/news/'):
+        return _set_web_info
+    if host == 'journals.aps.org' and not url.path.startswith('/prl/'):
+        return _set_web_info
+
+    # Look up the host and then its parent domains, e.g., export.arxiv.org
+    labels = host.split('.')
+    for i in range(len(labels) - 1):
+        handler = _HOST_DISPATCH.get('.'.join(labels[i:]))
+        if handler is not None:
+            return handler
+
+    return None
+
+
+def _set_info(paper):
+    """
+    Retrieve paper information from the html with the parser for the
+    website of `paper.url`.
+
+    :param paper: Paper object to scrape html information.
+    :type paper: Paper
+    :return: Paper object with html information retrieved.
+    :rtype: Paper
+    """
+    handler = _get_handler(paper.url)
+
+    if handler is None:
+        if getattr(paper, 'is_arxiv', False):
+            handler = _set_arxiv_info
+        else:
+            handler = _set_web_info
+
+    return handler(paper)
+
+
+def _get_text(element, descriptor):
+    """
+    Get the text of an element, including the text inside links and other
+    child elements, without its leading descriptor, e.g., 'Title:'.
+
+    :param element: Element to get the text of.
+    :type element: lxml.html.HtmlElement
+    :param descriptor: Label in front of the text.
+    :type descriptor: str
+    :return: Text of the element.
+    :rtype: str
+    """
+    text = element.text_content().strip()
+    if text.startswith(descriptor):
+        text = text[len(descriptor):].strip()
+    return text
+
+
 def _set_arxiv_info(paper):
     """
     Retrieve paper information from the html.
@@ -80,95 +265,71 @@ def _set_arxiv_info(paper):
     :return: SubmittedPaper object with html information retrieved.
     :rtype: SubmittedPaper
     """
-    # Remove all the muck that screws up the BeautifulSoup parser
+    # Remove all the muck that screws up the parser
     # Will fail on PDF submission, so take care of that exception first
     try:
-        fixed_html =re.sub(re.compile("<!--.*?-->", re.DOTALL), "", paper.html)
-        soup = bs(fixed_html, 'lxml')
+        fixed_html = _COMMENT_RE.sub('', paper.html)
+        tree = lxml.html.fromstring(fixed_html)
         paper.errors = '0'
     except:
         return None
 
     # Grab the Title, Date, and Authors, and all the other stuff
     try:
-        paper.title = soup.find('h1',
-                                {'class': 'title mathjax'}).contents[1].string
+        paper.title = _get_text(_ARXIV_TITLE(tree)[0], 'Title:')
+        if paper.title == '':
+            raise ValueError('Missing title')
     except:
         paper.errors = '1'
         paper.title = 'Error Grabbing Title'
 
-    #print paper.title + "\n"
-
     try:
-        authors = soup.find('div', {'class': 'authors'})
-        authors = authors.findAll('a')
+        authors = _ARXIV_AUTHORS(tree)
+        if not authors:
+            raise ValueError('Missing authors')
         paper.author_number = len(authors)
-        # Convert the authors to strings only and replace the relative links
-        author_list = []
-        for i in authors:
-            author_list.append(str(i).replace('/find/',
-                                              'http://arxiv.org/find/'))
-        paper.author = ', '.join(author_list[0:4])
-        # Kill all affiliation marks since some have them and some don't; done
-        # in two steps to take care of nested parens
-        paper.author = re.sub(r'\([^()]*\)', '', paper.author)
-        paper.author = re.sub(r'\([^()]*\)', '', paper.author)
+        # Keep only the names of the first four authors, reading the text of
+        # the links directly instead of serializing them
+        paper.author = ', '.join(i.text_content() for i in authors[0:4])
+        # Kill all affiliation marks since some have them and some don't;
+        # repeat until none is left to take care of nested parens
+        paper.author, count = _PAREN_RE.subn('', paper.author)
+        while count > 0:
+            paper.author, count = _PAREN_RE.subn('', paper.author)
     except:
         paper.errors = '1'
         paper.author = 'Error Grabbing Authors'
 
-    #   print paper.errors + paper.author + "\n"
-
     try:
-        date = soup.find('div', {'class':'submission-history'})
-        date = date.findAll(text=True) # Remove HTML tags
-        date = list(dict.fromkeys(date)) # ignoring multiple \n's
-        date = date[-1].split() # Most recent revision date will be the last
+        date = _ARXIV_HISTORY(tree)  # Text without the HTML tags
+        date = list(dict.fromkeys(date))  # ignoring multiple \n's
+        date = date[-1].split()  # Most recent revision date will be the last
         paper.date = date[1] + ' ' + date[2] + ' ' + date[3]
     except:
         paper.errors = '1'
         paper.date = 'Error Grabbing Date'
 
-    #   print paper.errors + paper.date + "\n"
-
     try:
-        paper.abstract = soup.find('blockquote',
-                                   {'class': 'abstract mathjax'}).contents[2]
+        paper.abstract = _get_text(_ARXIV_ABSTRACT(tree)[0], 'Abstract:')
+        if paper.abstract == '':
+            raise ValueError('Missing abstract')
     except:
         paper.errors = '1'
         paper.abstract = 'Error Grabbing Abstract'
 
-    #   print paper.errors + paper.abstract + "\n"
-
     try:
-        sources = soup.find('div', {'class': 'full-text'})
-        sources  = sources.findAll('a')
-        source_list=[]
-        for source in sources:
-            source = str(source)
-            source = source.replace('/ps','http://arxiv.org/ps')
-            source = source.replace('/pdf','http://arxiv.org/pdf')
-            source = source.replace('/format','http://arxiv.org/format')
-            source = source.replace('PostScript','PS')
-            source = source.replace('Other formats','Other')
-            if 'license' in source:
-                continue
-            source_list.append(source)
-        paper.sources = ' '.join(source_list)
+        sources = _get_arxiv_sources(_ARXIV_SOURCES(tree))
+        paper.sources = json.dumps(sources)
     except:
         paper.errors = '1'
         paper.sources = ''
 
-    #   print paper.errors + paper.sources + "\n"
-
     try:
-        paper.subject = soup.find('span', {'class': 'primary-subject'}).string
+        paper.subject = _ARXIV_SUBJECT(tree)[0]
     except:
         paper.errors = '1'
         paper.subject = 'Error Grabbing Subject'
 
-    #   print paper.errors + paper.subject + "\n"
-
     #try:
     #paper.comments = soup.find('td', {'class':'tablecell comments'}).string
     #except:
@@ -296,3 +457,22 @@ def _set_vixra_info(paper):
     :rtype: SubmittedPaper
     """
     pass
+
+
+# Parser for each website, looked up by the host of the paper url
+_HOST_DISPATCH = {
+    'nature.com': _set_nature_info,
+    'adsabs.harvard.edu': _set_ads_info,
+    'arxiv.org': _set_arxiv_info,
+    'xxx.lanl.gov': _set_arxiv_info,
+    'aanda.org': _set_aanda_info,
+    'mnras.oxfordjournals.org': _set_mnras_info,
+    'science.sciencemag.org': _set_science_info,
+    'physicstoday.scitation.org': _set_physicstoday_info,
+    'journals.aps.org': _set_prl_info,
+    'voxcharta.org': _set_voxcharta_info,
+    'vixra.org': _set_vixra_info,
+}
+
+# Parsers that are implemented, so that rescraping their pages is useful
+_RESCRAPE_PARSERS = (_set_arxiv_info,)
@@ -1 +1,12 @@
-# -*- coding: utf-8 -*-
\ No newline at end of file
+# -*- coding: utf-8 -*-
+
+# Number of SQLite connections shared by the whole process.
+SQLITE_POOL_SIZE = 5
+
+# Seconds to wait for a free connection before answering with an error.
+SQLITE_POOL_TIMEOUT = 10
+
+# Cache for the homepage query; cleared whenever a paper is added or
+# (un)marked as discussed.
+CACHE_TYPE = 'SimpleCache'
+CACHE_DEFAULT_TIMEOUT = 300
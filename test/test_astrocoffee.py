@@ -1,7 +1,10 @@
 """
 Tests for `astrocoffee` module.
 """
+import json
+from datetime import datetime
 import pytest
+import lxml.html
 from astrocoffee import astrocoffee, web, paper
 
 
@@ -17,3 +20,292 @@ class TestAstrocoffee(object):
     @classmethod
     def teardown_class(cls):
         pass
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """Test client of the app with a fresh database and an empty cache."""
+    app = astrocoffee.app
+    monkeypatch.setitem(app.config, 'DATABASE', str(tmp_path / 'test.db'))
+    monkeypatch.setitem(app.config, 'TESTING', True)
+    monkeypatch.setattr(astrocoffee, '_pool', None)
+
+    with app.app_context():
+        astrocoffee.init_db()
+    astrocoffee.cache.clear()
+
+    yield app.test_client()
+
+    astrocoffee.close_pool()
+    astrocoffee.cache.clear()
+
+
+def make_paper(title):
+    """Get a paper as `get_paper` returns it for a new submission."""
+    submitted = paper.Paper()
+    submitted.url = 'http://arxiv.org/abs/1604.03939'
+    submitted.title = title
+    submitted.author = 'Anowar J. Shajib'
+    submitted.author_number = 1
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    submitted.date_submitted = now
+    submitted.date_extended = now
+    return submitted
+
+
+class TestViews(object):
+
+    def test_submit_and_mark_discussed(self, client, monkeypatch):
+        monkeypatch.setattr(astrocoffee, 'get_paper',
+                            lambda url: make_paper('A big lens'))
+
+        page = client.get('/').get_data(as_text=True)
+        assert 'No papers submitted yet' in page
+
+        # The paper is in the very response to the submission
+        response = client.post('/submit', data={'article': '1604.03939'})
+        page = response.get_data(as_text=True)
+        assert response.status_code == 200
+        assert 'A big lens' in page
+        assert 'successfully added' in page
+
+        page = client.get('/').get_data(as_text=True)
+        assert 'A big lens' in page
+        assert 'Papers already discussed' not in page
+
+        with client.session_transaction() as sess:
+            sess['logged_in'] = True
+        response = client.get('/mark_discussed?paper_id=1')
+        assert response.status_code == 302
+
+        page = client.get('/').get_data(as_text=True)
+        assert 'No papers submitted yet' in page
+        assert 'Papers already discussed' in page
+        assert 'A big lens' in page
+        assert 'Mark paper as not discussed' in page
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, text=''):
+        self.status_code = status_code
+        self.text = text
+
+
+class FakeSession(object):
+    """Answer HEAD and GET requests from fixed status codes per url."""
+
+    def __init__(self, head, get):
+        self.head_status = head
+        self.get_status = get
+        self.calls = []
+
+    def head(self, url, **kwargs):
+        self.calls.append(('head', url))
+        return FakeResponse(self.head_status.get(url, 404))
+
+    def get(self, url, **kwargs):
+        self.calls.append(('get', url))
+        return FakeResponse(self.get_status.get(url, 404), 'html of ' + url)
+
+
+class TestPaper(object):
+
+    def test_url_with_scheme_gets_single_get(self, monkeypatch):
+        url = 'http://arxiv.org/abs/1604.03939'
+        session = FakeSession(head={}, get={url: 200})
+        monkeypatch.setattr(paper, '_session', session)
+
+        submitted = paper.SubmittedPaper('1604.03939')
+
+        assert submitted.url == url
+        assert submitted.html == 'html of ' + url
+        assert session.calls == [('get', url)]
+
+    def test_url_with_scheme_not_found(self, monkeypatch):
+        session = FakeSession(head={}, get={})
+        monkeypatch.setattr(paper, '_session', session)
+
+        submitted = paper.SubmittedPaper('http://example.com/missing')
+
+        assert submitted.url == ''
+        assert submitted.errors != '0'
+        assert session.calls == [('get', 'http://example.com/missing')]
+
+    def test_candidates_in_order_of_preference(self, monkeypatch):
+        found = {'http://example.com/paper': 200,
+                 'http://www.example.com/paper': 200}
+        session = FakeSession(head=found, get=found)
+        monkeypatch.setattr(paper, '_session', session)
+
+        submitted = paper.SubmittedPaper('example.com/paper')
+
+        assert submitted.url == 'http://example.com/paper'
+        assert submitted.html == 'html of http://example.com/paper'
+        assert session.calls.count(('get', 'http://example.com/paper')) == 1
+        assert ('get', 'http://www.example.com/paper') not in session.calls
+
+    def test_less_preferred_candidate(self, monkeypatch):
+        found = {'http://www.example.com/paper': 200}
+        session = FakeSession(head=found, get=found)
+        monkeypatch.setattr(paper, '_session', session)
+
+        submitted = paper.SubmittedPaper('example.com/paper')
+
+        assert submitted.url == 'http://www.example.com/paper'
+
+    def test_head_refused_falls_back_to_get(self, monkeypatch):
+        url = 'http://example.com/paper'
+        session = FakeSession(head={url: 405}, get={url: 200})
+        monkeypatch.setattr(paper, '_session', session)
+
+        submitted = paper.SubmittedPaper('example.com/paper')
+
+        assert submitted.url == url
+        assert submitted.html == 'html of ' + url
+        assert session.calls.count(('get', url)) == 1
+
+
+ARXIV_PAGE = """<!DOCTYPE html>
+<html><head><title>[1604.03939] A big lens</title></head><body>
+<!-- Header comment -->
+<div id="abs">
+<h1 class="title mathjax"><span class="descriptor">Title:</span>A <i>big</i>
+ lens</h1>
+<div class="authors"><span class="descriptor">Authors:</span>
+<a href="/find/astro-ph/1/au:+Shajib_A/0/1/0/all/0/1">Anowar J. Shajib</a>,
+<a href="/find/astro-ph/1/au:+Treu_T/0/1/0/all/0/1">Tommaso Treu</a> (UCLA),
+<a href="/find/astro-ph/1/au:+Agnello_A/0/1/0/all/0/1">Adriano Agnello</a>,
+<a href="/find/astro-ph/1/au:+Gautam_A/0/1/0/all/0/1">Abhimat Gautam</a>,
+<a href="/find/astro-ph/1/au:+Birrer_S/0/1/0/all/0/1">Simon Birrer</a>
+</div>
+<blockquote class="abstract mathjax">
+<span class="descriptor">Abstract:</span> We model the lens with $H_0$.
+Code at <a href="https://github.com/x">this https URL</a>. Done.
+</blockquote>
+<td class="tablecell subjects">
+<span class="primary-subject">Astrophysics of Galaxies (astro-ph.GA)</span>
+</td>
+</div>
+<div class="full-text"><h2>Download:</h2><ul>
+<li><a href="/pdf/1604.03939v2" accesskey="f">PDF</a></li>
+<li><a href="/ps/1604.03939v2">PostScript</a></li>
+<li><a href="/format/1604.03939v2">Other formats</a></li>
+</ul>
+<div class="abs-license"><a href="http://arxiv.org/licenses/nonexclusive-
+distrib/1.0/">license</a></div></div>
+<div class="submission-history"><h2>Submission history</h2>
+From: Anowar J. Shajib<br/>
+<strong>[v1]</strong> Wed, 13 Apr 2016 20:00:01 UTC (1,120 KB)<br/>
+<strong>[v2]</strong> Thu, 14 Apr 2016 10:00:00 UTC (1,121 KB)</div>
+</body></html>
+"""
+
+
+class TestWeb(object):
+
+    def test_set_arxiv_info(self):
+        submitted = paper.Paper()
+        submitted.html = ARXIV_PAGE
+
+        submitted = web._set_arxiv_info(submitted)
+
+        assert submitted.errors == '0'
+        assert submitted.title == 'A big\n lens'
+        assert submitted.author == ('Anowar J. Shajib, Tommaso Treu, '
+                                    'Adriano Agnello, Abhimat Gautam')
+        assert submitted.author_number == 5
+        assert submitted.date == '14 Apr 2016'
+        assert submitted.abstract == ('We model the lens with $H_0$.\n'
+                                      'Code at this https URL. Done.')
+        assert json.loads(submitted.sources) == [['pdf', '1604.03939v2'],
+                                                 ['ps', '1604.03939v2'],
+                                                 ['format', '1604.03939v2']]
+        assert submitted.subject == 'Astrophysics of Galaxies (astro-ph.GA)'
+
+    def test_set_arxiv_info_without_html(self):
+        submitted = paper.Paper()
+        submitted.html = ''
+
+        assert web._set_arxiv_info(submitted) is None
+
+    legacy_author = ('<a href="http://arxiv.org/find/astro-ph/1/au:+Shajib_A'
+                     '/0/1/0/all/0/1">Anowar J. Shajib</a>, '
+                     '<a href="http://arxiv.org/find/astro-ph/1/au:+Treu_T'
+                     '/0/1/0/all/0/1">Tommaso Treu</a>')
+    legacy_sources = ('<a href="http://arxiv.org/pdf/1604.03939v2">PDF</a> '
+                      '<a href="http://arxiv.org/ps/1604.03939v2">PS</a> '
+                      '<a href="http://arxiv.org/format/1604.03939v2">'
+                      'Other</a>')
+
+    def test_convert_legacy_fields(self):
+        author, sources = web.convert_legacy_fields(self.legacy_author,
+                                                    self.legacy_sources)
+
+        assert author == 'Anowar J. Shajib, Tommaso Treu'
+        assert json.loads(sources) == [['pdf', '1604.03939v2'],
+                                       ['ps', '1604.03939v2'],
+                                       ['format', '1604.03939v2']]
+
+    def test_convert_legacy_fields_is_idempotent(self):
+        converted = web.convert_legacy_fields(self.legacy_author,
+                                              self.legacy_sources)
+
+        assert web.convert_legacy_fields(*converted) == converted
+        assert web.convert_legacy_fields('', '') == ('', '')
+        assert web.convert_legacy_fields(None, None) == (None, None)
+
+    def test_get_arxiv_sources(self):
+        html = ('<div><a href="/pdf/astro-ph/0601001v1">PDF</a>'
+                '<a href="https://arxiv.org/format/1604.03939">Other</a>'
+                '<a href="http://arxiv.org/licenses/nonexclusive-distrib'
+                '/1.0/">license</a><a>No link</a></div>')
+        links = lxml.html.fromstring(html).iter('a')
+
+        assert web._get_arxiv_sources(links) == [
+            ('pdf', 'astro-ph/0601001v1'), ('format', '1604.03939')]
+
+    @pytest.mark.parametrize('url, handler', [
+        ('http://arxiv.org/abs/1604.03939', '_set_arxiv_info'),
+        ('https://export.arxiv.org/abs/1604.03939', '_set_arxiv_info'),
+        ('http://arxiv.org:80/abs/1604.03939', '_set_arxiv_info'),
+        ('http://xxx.lanl.gov/abs/1604.03939', '_set_arxiv_info'),
+        ('https://www.nature.com/articles/nature12345', '_set_nature_info'),
+        ('https://www.nature.com/news/some-story', '_set_web_info'),
+        ('https://journals.aps.org/prl/abstract/10.1103/x',
+         '_set_prl_info'),
+        ('https://journals.aps.org/prd/abstract/10.1103/x',
+         '_set_web_info'),
+        ('https://example.com/arxiv.org', '_set_web_info'),
+    ])
+    def test_set_info_dispatch(self, monkeypatch, url, handler):
+        handlers = [name for name in dir(web)
+                    if name.startswith('_set_') and name != '_set_info']
+        for name in handlers:
+            monkeypatch.setattr(web, name, lambda p, name=name: name)
+        for host, function in list(web._HOST_DISPATCH.items()):
+            monkeypatch.setitem(web._HOST_DISPATCH, host,
+                                getattr(web, function.__name__))
+
+        submitted = paper.Paper()
+        submitted.url = url
+
+        assert web._set_info(submitted) == handler
+
+    def test_rescrape_papers_fetches_only_parsed_hosts(self, monkeypatch):
+        fetched = []
+
+        async def fake_fetch_papers(urls, concurrency):
+            fetched.extend(urls)
+            return [ARXIV_PAGE for url in urls]
+
+        monkeypatch.setattr(web, 'fetch_papers', fake_fetch_papers)
+        urls = ['https://example.com/paper',
+                'http://arxiv.org/abs/1604.03939',
+                'https://www.nature.com/articles/nature12345']
+
+        papers = web.rescrape_papers(urls)
+
+        assert fetched == ['http://arxiv.org/abs/1604.03939']
+        assert papers[0] is None and papers[2] is None
+        assert papers[1].title == 'A big\n lens'